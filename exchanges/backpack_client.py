@@ -1,20 +1,87 @@
 #!/usr/bin/env python
 
+import asyncio
+import json
+import logging
+import socket
+import time
 from decimal import Decimal, ROUND_DOWN, ROUND_HALF_UP
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import httpx
 from bpx.account import Account
 from bpx.constants.enums import OrderTypeEnum, TimeInForceEnum
+from bpx.http_client.sync_http_client import SyncHttpClient
 from bpx.public import Public
 
 from helpers.logger import setup_logger
+from helpers.rate_limiter import RateLimiter, RateLimitError, call_with_backoff
 from model.order_info import OrderInfo
 from model.order_result import OrderResult
 from model.trading_config import TradingConfig
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 logger = setup_logger('backpack_client')
 
 
+class Http2Client(SyncHttpClient):
+    """HTTP/2 client for the bpx SDK, all requests are multiplexed onto one keep-alive TLS connection."""
+
+    # 429不在这里重试，直接抛RateLimitError交给call_with_backoff统一退避，避免两层重试叠加
+    RETRY_STATUS = frozenset({502, 503, 504})
+    # 与urllib3的Retry一致，只对幂等请求按状态码重试，下单的POST不会被重复提交
+    RETRY_METHODS = frozenset({'GET', 'DELETE'})
+
+    def __init__(self, max_connections: int = 32, max_retries: int = 3, backoff_factor: float = 0.2):
+        super().__init__()
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        transport = httpx.HTTPTransport(
+            http2=True,
+            retries=max_retries,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        )
+        self.client = httpx.Client(http2=True, transport=transport)
+
+    @staticmethod
+    def _parse(response: httpx.Response):
+        try:
+            return json_loads(response.content)
+        except json.JSONDecodeError:
+            return response.text
+
+    def _request(self, method, url, **kwargs):
+        response = self.client.request(method, url, **kwargs)
+        if method in self.RETRY_METHODS:
+            for attempt in range(self.max_retries):
+                if response.status_code not in self.RETRY_STATUS:
+                    break
+                time.sleep(self.backoff_factor * 2 ** attempt)
+                response = self.client.request(method, url, **kwargs)
+
+        if response.status_code == 429:
+            raise RateLimitError(f'{method} {url} is rate limited: {response.text}')
+
+        return self._parse(response)
+
+    def get(self, url, headers=None, params=None):
+        return self._request('GET', url, headers=headers, params=params)
+
+    def post(self, url, headers=None, data=None):
+        return self._request('POST', url, headers=headers, json=data)
+
+    def delete(self, url, headers=None, data=None):
+        return self._request('DELETE', url, headers=headers, json=data)
+
+    def patch(self, url, headers=None, data=None):
+        return self._request('PATCH', url, headers=headers, json=data)
+
+
 class CustomAccountClient:
     def __init__(self, account_client, broker_id='2110'):
         self.account_client = account_client
@@ -41,8 +108,11 @@ class CustomAccountClient:
 
 
 class BackpackClient(object):
+    MARKETS_CACHE_TTL = 300
+    # (缓存时间, {(baseSymbol, quoteSymbol, marketType): market})
+    _markets_cache: Tuple[float, Dict[Tuple[str, str, str], dict]] = (0, {})
 
-    def __init__(self, config: TradingConfig):
+    def __init__(self, config: TradingConfig, max_concurrent_orders: int = 8, requests_per_second: float = 20):
         self.config = config
         self.public_key = config.public_key
         self.secret_key = config.secret_key
@@ -50,22 +120,30 @@ class BackpackClient(object):
         if not self.public_key or not self.secret_key:
             raise ValueError("BACKPACK_PUBLIC_KEY and BACKPACK_SECRET_KEY must be set in environment variables")
 
-        # Initialize Backpack clients using official SDK
-        self.public_client = Public()
+        # Initialize Backpack clients using official SDK, sharing one HTTP/2 connection
+        self.http_client = Http2Client()
+        self.public_client = Public(http_client=self.http_client)
         self.account_client = Account(
             public_key=self.public_key,
-            secret_key=self.secret_key
+            secret_key=self.secret_key,
+            default_http_client=self.http_client
         )
 
         self.custom_client = CustomAccountClient(self.account_client)
         self.logger = logger
 
+        # 限制同时在途的下单请求数量，避免触发交易所限频
+        self.order_semaphore = asyncio.Semaphore(max_concurrent_orders)
+        # 下单和撤单共用同一个限频器
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self._tick = config.tick_size
+
     def round_to_tick(self, price) -> Decimal:
-        price = Decimal(price)
+        if not isinstance(price, Decimal):
+            price = Decimal(price)
 
-        tick = self.config.tick_size
         # quantize forces price to be a multiple of tick
-        return price.quantize(tick, rounding=ROUND_HALF_UP)
+        return price.quantize(self._tick, rounding=ROUND_HALF_UP)
 
     @staticmethod
     def align_floor(quantity: Decimal, min_quantity: Decimal) -> Decimal:
@@ -79,138 +157,126 @@ class BackpackClient(object):
         Returns:
             向下对齐后的数量
         """
-        multiplier = (quantity / min_quantity).to_integral_value(rounding=ROUND_DOWN)
-        return multiplier * min_quantity
+        unit = min_quantity.normalize()
+        _, digits, exponent = unit.as_tuple()
+        if digits == (1,) and exponent <= 0:
+            # 最小单位是10的负整数次幂时直接截断小数位，避免Decimal除法
+            return quantity.quantize(unit, rounding=ROUND_DOWN)
 
-    async def batch_place_buy_limit_orders(
-            self, contract_id: str, quantity: Decimal,
+        return (quantity // min_quantity) * min_quantity
+
+    def _build_ladder(self, side: str, bids: list, asks: list, order_num: int) -> List[str]:
+        """
+        以盘口为基准，按 base_multiple 倍价差向外生成挂单价格
+
+        Args:
+            side: 'Bid' 或 'Ask'
+            bids: 买盘，最后一档为最优买价
+            asks: 卖盘，第一档为最优卖价
+            order_num: 挂单数量
+
+        Returns:
+            对齐到tick后的价格字符串列表，由近到远
+        """
+        best_ask = Decimal(asks[0][0])
+        best_bid = Decimal(bids[-1][0])
+        base = self.config.base_multiple * (best_ask - best_bid)
+        if side == 'Bid':
+            basic, base = best_bid, -base
+        else:
+            basic = best_ask
+
+        return [str(self.round_to_tick(basic + base * (i + 1))) for i in range(order_num)]
+
+    async def _batch_place_limit_orders(
+            self, side: str, contract_id: str, quantity: Decimal,
             order_num: int, position_rate: float):
         align_quantity = BackpackClient.align_floor(quantity, self.config.min_quantity)
+        side_name = 'buy' if side == 'Bid' else 'sell'
+
         self.logger.info(
-            f'batch place sell limit orders, contract id: {contract_id}, '
-            f'min quantity: {self.config.min_quantity}, '
-            f'quantity: {quantity:.4f}, '
-            f'align quantity: {align_quantity}, '
-            f'order num: {order_num}')
-        order_book = self.public_client.get_depth(contract_id)
+            'batch place %s limit orders, contract id: %s, '
+            'min quantity: %s, quantity: %.4f, align quantity: %s, order num: %s',
+            side_name, contract_id, self.config.min_quantity, quantity, align_quantity, order_num)
+        # 5xx重试会在共享客户端里同步退避，放到线程中执行，避免阻塞事件循环
+        order_book = await asyncio.to_thread(self.public_client.get_depth, contract_id)
         if not isinstance(order_book, dict):
             return OrderResult(success=False, error_message='Unexpected order book response format')
 
         bids = order_book.get('bids', [])
         asks = order_book.get('asks', [])
-        orders = []
 
-        side = 'Bid'
-        basic_bid = bids[-1][0]
+        self.logger.info(
+            'place %s limit order, position rate: %s, base multiple: %s',
+            side_name, position_rate, self.config.base_multiple)
 
-        base_multiple = self.config.base_multiple
+        prices = self._build_ladder(side, bids, asks, order_num)
 
-        self.logger.info(
-            f'place sell limit order, '
-            f'position rate: {position_rate}, '
-            f'base multiple: {base_multiple}')
-
-        base = base_multiple * (Decimal(asks[0][0]) - Decimal(bids[-1][0]))
-        for i in range(order_num):
-            order_price = Decimal(basic_bid) - base * (i + 1)
-            try:
-                order_result = self.custom_client.execute_order(
-                    symbol=contract_id,
-                    side=side,
-                    order_type=OrderTypeEnum.LIMIT,
-                    quantity=str(align_quantity),
-                    price=str(self.round_to_tick(order_price)),
-                    post_only=True,
-                    time_in_force=TimeInForceEnum.GTC
-                )
-
-                if not order_result:
-                    self.logger.info(
-                        f'exception in place order, symbol: {contract_id}, '
-                        f'quantity: {align_quantity}, order price: {order_price}')
-
-                if 'code' in order_result:
-                    message = order_result.get('message', 'Unknown error')
-                    self.logger.warning(f"[OPEN] Error placing order: {message}")
-                    continue
-
-                order_id = order_result.get('id')
-                orders.append(order_id)
-                if not order_id:
-                    self.logger.error(f"[OPEN] No order ID in response: {order_result}")
-            except Exception as e:
-                self.logger.info(f'exception in batch place orders: {e}')
+        return await self._submit_limit_orders(contract_id, side, str(align_quantity), prices)
 
-        return orders
+    async def batch_place_buy_limit_orders(
+            self, contract_id: str, quantity: Decimal,
+            order_num: int, position_rate: float):
+        return await self._batch_place_limit_orders('Bid', contract_id, quantity, order_num, position_rate)
 
     async def batch_place_sell_limit_orders(
             self, contract_id: str, quantity: Decimal,
             order_num: int, position_rate: float):
+        return await self._batch_place_limit_orders('Ask', contract_id, quantity, order_num, position_rate)
+
+    async def _place_limit_order(self, contract_id: str, side: str, quantity: str, price: str):
+        async with self.order_semaphore:
+            return await call_with_backoff(
+                self.rate_limiter,
+                self.custom_client.execute_order,
+                symbol=contract_id,
+                side=side,
+                order_type=OrderTypeEnum.LIMIT,
+                quantity=quantity,
+                price=price,
+                post_only=True,
+                time_in_force=TimeInForceEnum.GTC
+            )
 
-        align_quantity = BackpackClient.align_floor(quantity, self.config.min_quantity)
-
-        self.logger.info(
-            f'batch place sell limit orders, contract id: {contract_id}, '
-            f'min quantity: {self.config.min_quantity}, '
-            f'quantity: {quantity:.4f}, '
-            f'align quantity: {align_quantity}, '
-            f'order num: {order_num}')
-        order_book = self.public_client.get_depth(contract_id)
-        if not isinstance(order_book, dict):
-            return OrderResult(success=False, error_message='Unexpected order book response format')
-
-        bids = order_book.get('bids', [])
-        asks = order_book.get('asks', [])
+    async def _submit_limit_orders(
+            self, contract_id: str, side: str, quantity: str, prices: List[str]) -> List[str]:
+        """并发提交同一方向的一组限价单，返回按价格顺序排列的订单ID列表。"""
+        results = await asyncio.gather(
+            *(self._place_limit_order(contract_id, side, quantity, price) for price in prices),
+            return_exceptions=True
+        )
 
         orders = []
-
-        side = 'Ask'
-        base_multiple = self.config.base_multiple
-
-        self.logger.info(
-            f'place sell limit order, '
-            f'position rate: {position_rate}, '
-            f'base multiple: {base_multiple}')
-
-        basic_ask = asks[0][0]
-        base = base_multiple * (Decimal(asks[0][0]) - Decimal(bids[-1][0]))
-        for i in range(order_num):
-            order_price = Decimal(basic_ask) + base * (i + 1)
-            try:
-                order_result = self.custom_client.execute_order(
-                    symbol=contract_id,
-                    side=side,
-                    order_type=OrderTypeEnum.LIMIT,
-                    quantity=str(align_quantity),
-                    price=str(self.round_to_tick(order_price)),
-                    post_only=True,
-                    time_in_force=TimeInForceEnum.GTC
-                )
-
-                if not order_result:
-                    self.logger.info(
-                        f'exception in place order, symbol: {contract_id}, '
-                        f'quantity: {align_quantity}, order price: {order_price}')
-                    continue
-
-                if 'code' in order_result:
-                    message = order_result.get('message', 'Unknown error')
-                    self.logger.warning(f"[OPEN] Error placing order: {message}")
-                    continue
-
-                order_id = order_result.get('id')
-                orders.append(order_id)
-                if not order_id:
-                    self.logger.error(f"[OPEN] No order ID in response: {order_result}")
-            except Exception as e:
-                self.logger.warning(f'exception in batch place orders: {e}')
+        for price, order_result in zip(prices, results):
+            if isinstance(order_result, Exception):
+                self.logger.warning(f'exception in batch place orders: {order_result}')
+                continue
+
+            if not order_result:
+                self.logger.info(
+                    'exception in place order, symbol: %s, quantity: %s, order price: %s',
+                    contract_id, quantity, price)
+                continue
+
+            if 'code' in order_result:
+                message = order_result.get('message', 'Unknown error')
+                self.logger.warning(f"[OPEN] Error placing order: {message}")
+                continue
+
+            order_id = order_result.get('id')
+            if not order_id:
+                self.logger.error(f"[OPEN] No order ID in response: {order_result}")
+                continue
+            orders.append(order_id)
 
         return orders
 
     async def cancel_order(self, order_id: str) -> OrderResult:
         try:
             # Cancel the order using Backpack SDK
-            cancel_result = self.account_client.cancel_order(
+            cancel_result = await call_with_backoff(
+                self.rate_limiter,
+                self.account_client.cancel_order,
                 symbol=self.config.contract_id,
                 order_id=order_id
             )
@@ -228,11 +294,32 @@ class BackpackClient(object):
         except Exception as e:
             return OrderResult(success=False, error_message=str(e))
 
+    async def cancel_all_orders(self, contract_id: str) -> OrderResult:
+        """Cancel every open order of a contract with a single request."""
+        try:
+            cancel_result = await call_with_backoff(
+                self.rate_limiter,
+                self.account_client.cancel_all_orders,
+                symbol=contract_id
+            )
+
+            if isinstance(cancel_result, dict) and 'code' in cancel_result:
+                message = cancel_result.get('message', 'Unknown error')
+                self.logger.error(f"[CLOSE] Failed to cancel all orders of {contract_id}: {message}")
+                return OrderResult(success=False, error_message=message)
+            if not isinstance(cancel_result, list):
+                return OrderResult(success=False, error_message=f'Unexpected cancel response: {cancel_result}')
+
+            return OrderResult(success=True)
+
+        except Exception as e:
+            return OrderResult(success=False, error_message=str(e))
+
     async def get_active_orders(self, contract_id: str) -> List[OrderInfo]:
         """Get active orders for a contract using official SDK."""
         try:
             # Get active orders using Backpack SDK
-            active_orders = self.account_client.get_open_orders(symbol=contract_id)
+            active_orders = await asyncio.to_thread(self.account_client.get_open_orders, symbol=contract_id)
 
             if not active_orders:
                 return []
@@ -267,7 +354,7 @@ class BackpackClient(object):
     async def get_account_all_positions(self) -> List[Dict]:
         account_positions = []
         try:
-            positions_data = self.account_client.get_open_positions()
+            positions_data = await asyncio.to_thread(self.account_client.get_open_positions)
             for position in positions_data:
                 account_positions.append({
                     'symbol': position.get('symbol', ''),
@@ -280,7 +367,7 @@ class BackpackClient(object):
 
     async def get_account_positions(self) -> Decimal:
         try:
-            positions_data = self.account_client.get_open_positions()
+            positions_data = await asyncio.to_thread(self.account_client.get_open_positions)
             position_amt = 0
             for position in positions_data:
                 if position.get('symbol', '') == self.config.contract_id:
@@ -291,6 +378,19 @@ class BackpackClient(object):
             self.logger.warning(f'exception in get account positions: {e}')
             return Decimal(0)
 
+    def get_market(self, base_symbol: str, quote_symbol: str, market_type: str) -> Optional[dict]:
+        """按(baseSymbol, quoteSymbol, marketType)查找市场信息，市场列表缓存MARKETS_CACHE_TTL秒。"""
+        cached_at, markets_index = BackpackClient._markets_cache
+        if time.time() - cached_at >= self.MARKETS_CACHE_TTL:
+            markets = self.public_client.get_markets()
+            markets_index = {
+                (market.get('baseSymbol', ''), market.get('quoteSymbol', ''), market.get('marketType', '')): market
+                for market in markets
+            }
+            BackpackClient._markets_cache = (time.time(), markets_index)
+
+        return markets_index.get((base_symbol, quote_symbol, market_type))
+
     async def get_contract_attributes(self) -> Tuple[str, Decimal, Decimal]:
         """Get contract ID for a ticker."""
         ticker = self.config.ticker
@@ -298,18 +398,16 @@ class BackpackClient(object):
             self.logger.error("Ticker is empty")
             raise ValueError("Ticker is empty")
 
-        markets = self.public_client.get_markets()
-
         min_quantity = 0
-        for market in markets:
-            if (market.get('marketType', '') == 'PERP' and market.get('baseSymbol', '') == ticker and
-                    market.get('quoteSymbol', '') == 'USDC'):
-                self.logger.info(f'get contract attributes, ticker: {ticker}, market: {market}')
-                self.config.contract_id = market.get('symbol', '')
-                min_quantity = Decimal(market.get('filters', {}).get('quantity', {}).get('minQuantity', 0))
-                self.config.tick_size = Decimal(market.get('filters', {}).get('price', {}).get('tickSize', 0))
-                self.config.min_quantity = min_quantity
-                break
+        market = await asyncio.to_thread(self.get_market, ticker, 'USDC', 'PERP')
+        if market is not None:
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info('get contract attributes, ticker: %s, market: %s', ticker, market)
+            self.config.contract_id = market.get('symbol', '')
+            min_quantity = Decimal(market.get('filters', {}).get('quantity', {}).get('minQuantity', 0))
+            self.config.tick_size = Decimal(market.get('filters', {}).get('price', {}).get('tickSize', 0))
+            self._tick = self.config.tick_size
+            self.config.min_quantity = min_quantity
 
         if self.config.contract_id == '':
             self.logger.error("Failed to get contract ID for ticker")
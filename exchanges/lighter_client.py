@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
+import asyncio
+import csv
+import functools
+import itertools
+import logging
+import os
 import time
+from typing import Dict, Tuple
 
 import lighter
-import pandas as pd
 
 from config.config import lighter_api_key_index, lighter_private_key, lighter_account_index
 
@@ -12,6 +18,11 @@ from helpers.logger import setup_logger
 logger = setup_logger('lighter_client')
 
 
+@functools.lru_cache(maxsize=256)
+def _symbol_name(symbol: str) -> str:
+    return symbol.replace('USDT', '').replace('USDC', '').upper()
+
+
 class LighterClient(object):
     def __init__(self):
         self.url = 'https://mainnet.zklighter.elliot.ai'
@@ -30,91 +41,103 @@ class LighterClient(object):
             api_key_index=self.api_key_index,
         )
 
-        configuration = lighter.Configuration(
-            host="https://mainnet.zklighter.elliot.ai"
-        )
-        api_client = lighter.ApiClient(configuration)
+        # 复用signer client的ApiClient，所有REST请求共享同一个aiohttp连接池
+        api_client = self.signer_client.api_client
         self.account_api = lighter.AccountApi(api_client)
         self.order_api = lighter.OrderApi(api_client)
 
         self.account_total_asset_value = 0
-        self.order_book_df = pd.DataFrame()
+        # symbol -> (market_id, size_decimals, min_base_amount, 10 ** size_decimals)
+        self._symbol_info: Dict[str, Tuple[int, int, float, int]] = {}
         self.market_ids = []
 
-    @staticmethod
-    def symbol_name(symbol):
-        if symbol.find('USDT') >= 0:
-            symbol = symbol.replace('USDT', '')
-        elif symbol.find('USDC') >= 0:
-            symbol = symbol.repace('USDC', '')
+    async def _lookup(self, symbol):
+        """返回(lighter symbol, 市场信息元组)，不支持的symbol市场信息为None"""
+        if not self._symbol_info:
+            await self.get_order_book_details()
 
-        return symbol.upper()
+        new_symbol = _symbol_name(symbol)
+        symbol_info = self._symbol_info.get(new_symbol)
+        if symbol_info is None:
+            self.logger.info('symbol is not found: %s, is not supported!', new_symbol)
 
-    async def to_lighter_amount(self, symbol, basic_amount):
-        if self.order_book_df.shape[0] == 0:
-            await self.get_order_book_details()
+        return new_symbol, symbol_info
 
-        new_symbol = LighterClient.symbol_name(symbol)
-        tmp_df = self.order_book_df.loc[self.order_book_df.symbol == new_symbol].copy()
-        if tmp_df.shape[0] == 0:
-            self.logger.info(f'symbol is not found: {new_symbol}, is not supported!')
-            return 0
+    async def _resolve(self, symbol, basic_amount):
+        """一次查表同时得到market id和lighter下单数量，找不到时返回(-1, 0)"""
+        new_symbol, symbol_info = await self._lookup(symbol)
+        if symbol_info is None:
+            return -1, 0
 
-        tmp_df.reset_index(drop=True, inplace=True)
+        market_id, _, min_base_amount, size_multiplier = symbol_info
         amount = basic_amount
-        if amount < tmp_df.loc[0, 'min_base_amount']:
-            amount = tmp_df.loc[0, 'min_base_amount']
+        if amount < min_base_amount:
+            amount = min_base_amount
             self.logger.info(
-                f'amount is less than min base amount, amount: {amount}, '
-                f'min base amount: {tmp_df.loc[0, "min_base_amount"]}')
+                'amount is less than min base amount, amount: %s, min base amount: %s',
+                amount, min_base_amount)
 
-        lighter_amount = 10 ** tmp_df.loc[0, 'size_decimals'] * amount
+        lighter_amount = size_multiplier * amount
         self.logger.info(
-            f'to lighter amount, symbol: {symbol}, new symbol: {new_symbol}, '
-            f'basic_amount: {basic_amount}, amount: {amount}, lighter amount: {lighter_amount}')
+            'to lighter amount, symbol: %s, new symbol: %s, '
+            'basic_amount: %s, amount: %s, lighter amount: %s',
+            symbol, new_symbol, basic_amount, amount, lighter_amount)
+
+        return market_id, lighter_amount
 
+    async def to_lighter_amount(self, symbol, basic_amount):
+        _, lighter_amount = await self._resolve(symbol, basic_amount)
         return lighter_amount
 
     async def get_symbol_market_id(self, symbol):
-        if self.order_book_df.shape[0] == 0:
-            await self.get_order_book_details()
-
-        new_symbol = LighterClient.symbol_name(symbol)
-        tmp_df = self.order_book_df.loc[self.order_book_df.symbol == new_symbol].copy()
-        if tmp_df.shape[0] == 0:
-            self.logger.info(f'symbol is not found: {new_symbol}, is not supported!')
+        _, symbol_info = await self._lookup(symbol)
+        if symbol_info is None:
             return -1
 
-        tmp_df.reset_index(drop=True, inplace=True)
-
-        return int(tmp_df.loc[0, 'market_id'])
+        return symbol_info[0]
+
+    async def _fetch_active_orders(self, market_id, semaphore, max_retries=3):
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                try:
+                    api_response = await self.order_api.account_active_orders(
+                        account_index=self.account_index,
+                        authorization=self.auth_token,
+                        auth=self.auth_token,
+                        market_id=market_id
+                    )
+                    return api_response.orders
+                except lighter.ApiException as e:
+                    # 被限频时指数退避后重试
+                    if e.status != 429 or attempt == max_retries:
+                        raise
+                    await asyncio.sleep(0.5 * 2 ** attempt)
 
     async def get_active_orders(self):
-        all_orders = []
-        for market_id in self.market_ids:
-            try:
-                api_response = await self.order_api.account_active_orders(
-                    account_index=self.account_index,
-                    authorization=self.auth_token,
-                    auth=self.auth_token,
-                    market_id=market_id
-                )
-                orders = api_response.orders
-                all_orders.extend(orders)
-                print(f"The response of OrderApi->account_active_orders:\nmarket_id: {market_id}, orders: {orders}")
-            except Exception as e:
-                print("Exception when calling OrderApi->account_active_orders: %s\n" % e)
+        semaphore = asyncio.Semaphore(16)
+        results = await asyncio.gather(
+            *(self._fetch_active_orders(market_id, semaphore) for market_id in self.market_ids),
+            return_exceptions=True
+        )
+
+        market_orders = []
+        for market_id, orders in zip(self.market_ids, results):
+            if isinstance(orders, Exception):
+                print("Exception when calling OrderApi->account_active_orders: %s\n" % orders)
+                continue
 
-        return all_orders
+            print(f"The response of OrderApi->account_active_orders:\nmarket_id: {market_id}, orders: {orders}")
+            market_orders.append(orders)
+
+        return list(itertools.chain.from_iterable(market_orders))
 
     async def place_buy_market_order(self, symbol, amount):
-        market_index = await self.get_symbol_market_id(symbol)
-        lighter_amount = await self.to_lighter_amount(symbol, amount)
+        market_index, lighter_amount = await self._resolve(symbol, amount)
         lighter_amount = int(lighter_amount)
 
         self.logger.info(
-            f'place buy market order, symbol: {symbol}, amount: {amount}, '
-            f'market index: {market_index}, lighter amount: {lighter_amount}')
+            'place buy market order, symbol: %s, amount: %s, market index: %s, lighter amount: %s',
+            symbol, amount, market_index, lighter_amount)
 
         if market_index == -1:
             raise Exception(f'invalid market index: {market_index}, symbol: {symbol}')
@@ -130,7 +153,7 @@ class LighterClient(object):
             is_ask=False,
         )
 
-        self.logger.info(f'new created order: {order}')
+        self.logger.info('new created order: %s', order)
 
         return order
 
@@ -140,8 +163,7 @@ class LighterClient(object):
             # account
             api_response = await self.account_api.account('index', str(self.account_index))
             tmp_positions = api_response.accounts[0].positions
-            for i in range(len(tmp_positions)):
-                curr_position = tmp_positions[i]
+            for curr_position in tmp_positions:
                 positions.append({
                     'market_id': curr_position.market_id,
                     'symbol': curr_position.symbol,
@@ -159,13 +181,12 @@ class LighterClient(object):
         return positions
 
     async def place_sell_market_order(self, symbol, amount):
-        market_index = await self.get_symbol_market_id(symbol)
-        lighter_amount = await self.to_lighter_amount(symbol, amount)
+        market_index, lighter_amount = await self._resolve(symbol, amount)
         lighter_amount = int(lighter_amount)
 
         self.logger.info(
-            f'place sell market order, symbol: {symbol}, amount: {amount}, '
-            f'market index: {market_index}, lighter amount: {lighter_amount}')
+            'place sell market order, symbol: %s, amount: %s, market index: %s, lighter amount: %s',
+            symbol, amount, market_index, lighter_amount)
 
         if market_index == -1:
             raise Exception(f'invalid market index: {market_index}, symbol: {symbol}')
@@ -181,18 +202,25 @@ class LighterClient(object):
             is_ask=True,
         )
 
-        self.logger.info(f'new created order: {order}')
+        self.logger.info('new created order: %s', order)
 
         return order
 
+    @staticmethod
+    def _dump_order_book(filepath, columns, rows):
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
     async def get_order_book_details(self):
-        df = pd.DataFrame(columns=[
+        columns = [
             'symbol', 'market_id', 'status',
             'size_decimals',
             'min_quote_amount',
             'min_base_amount',
             'price_decimals'
-        ])
+        ]
 
         try:
             # OrderBookDetail(symbol='ETH', market_id=0, status='active', taker_fee='0.0000',
@@ -208,20 +236,27 @@ class LighterClient(object):
             api_response = await self.order_api.order_book_details()
             print("The response of OrderApi->order_book_details:\n")
             order_book_details = api_response.order_book_details
-            for i in range(len(order_book_details)):
-                order_book_detail = order_book_details[i]
-                df.loc[df.shape[0]] = [
-                    order_book_detail.symbol,
-                    order_book_detail.market_id,
-                    order_book_detail.status,
-                    order_book_detail.size_decimals,
-                    float(order_book_detail.min_quote_amount),
+            rows = [(
+                order_book_detail.symbol,
+                order_book_detail.market_id,
+                order_book_detail.status,
+                order_book_detail.size_decimals,
+                float(order_book_detail.min_quote_amount),
+                float(order_book_detail.min_base_amount),
+                order_book_detail.price_decimals
+            ) for order_book_detail in order_book_details]
+
+            self._symbol_info = {
+                order_book_detail.symbol: (
+                    int(order_book_detail.market_id),
+                    int(order_book_detail.size_decimals),
                     float(order_book_detail.min_base_amount),
-                    order_book_detail.price_decimals
-                ]
-
-            self.order_book_df = df.copy()
-            df.to_csv('order_book.csv', index=False)
+                    10 ** int(order_book_detail.size_decimals)
+                ) for order_book_detail in order_book_details
+            }
+            # 仅在调试时导出，写文件放到线程里避免阻塞事件循环
+            if os.getenv('DUMP_ORDER_BOOK'):
+                await asyncio.to_thread(LighterClient._dump_order_book, 'order_book.csv', columns, rows)
         except Exception as e:
             print("Exception when calling OrderApi->order_book_details: %s\n" % e)
 
@@ -234,8 +269,8 @@ class LighterClient(object):
                 self.account_total_asset_value = accounts[0].total_asset_value
 
             self.logger.info(
-                f"The response of AccountApi->account:\n{api_response}, "
-                f"account total asset value: {self.account_total_asset_value}")
+                "The response of AccountApi->account:\n%s, account total asset value: %s",
+                api_response, self.account_total_asset_value)
         except Exception as e:
             print("Exception when calling AccountApi->account: %s\n" % e)
 
@@ -264,14 +299,13 @@ class LighterClient(object):
                 return
 
             expiry_time = int(time.time() + 8 * 60)
-            expiry_readable = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expiry_time))
 
             self.auth_token = auth_token
             self.token_expiry_time = expiry_time
 
-            self.logger.info(
-                'Auth Token Successfully Created！Token: {auth_token}, '
-                'Expires at: {expiry_readable} (in 10 minutes), '
-                f'expiry readable: {expiry_readable}')
+            if self.logger.isEnabledFor(logging.INFO):
+                expiry_readable = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expiry_time))
+                self.logger.info(
+                    'Auth Token Successfully Created！Expires at: %s (in 10 minutes)', expiry_readable)
         except Exception as e:
             self.logger.info(f"Error: {str(e)}")
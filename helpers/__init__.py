@@ -3,5 +3,6 @@ Helper modules for perp-dex-tools.
 """
 
 from .logger import setup_logger
+from .rate_limiter import RateLimiter, RateLimitError, call_with_backoff
 
-__all__ = ['setup_logger']
+__all__ = ['setup_logger', 'RateLimiter', 'RateLimitError', 'call_with_backoff']
@@ -1,13 +1,31 @@
 #!/usr/bin/env python
 
+import atexit
 import os
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
+# 后台写日志的listener，进程退出时统一停止并刷盘
+_listeners = []
+
+
+def _stop_listeners():
+    for listener in _listeners:
+        listener.stop()
+
+
+atexit.register(_stop_listeners)
+
+
+def setup_logger(log_name, console_level=None):
+    logger = logging.getLogger(log_name)
+    # 重复调用时直接返回，避免同一个logger挂上多份handler导致日志重复输出
+    if logger.handlers:
+        return logger
 
-def setup_logger(log_name):
-    logger = logging.getLogger('backpack')
     logger.setLevel(logging.INFO)
+    logger.propagate = False
 
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
     logs_dir = os.path.join(project_root, 'logs')
@@ -22,11 +40,19 @@ def setup_logger(log_name):
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
+    # 生产环境可以设置环境变量LOG_CONSOLE_LEVEL=WARNING，控制台只输出告警，完整日志仍写入文件
+    if console_level is None:
+        console_level = os.getenv('LOG_CONSOLE_LEVEL', 'INFO').upper()
+    console_handler.setLevel(console_level)
     console_handler.setFormatter(formatter)
 
-    logger.addHandler(console_handler)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    # 事件循环线程只负责入队，控制台和文件的实际写入交给后台线程
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
 
     return logger
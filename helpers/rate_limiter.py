@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import asyncio
+import random
+import time
+
+
+class RateLimitError(Exception):
+    """Raised when the exchange answers with HTTP 429."""
+
+
+class RateLimiter:
+    """Async rate limiter that spaces requests at least 1 / rps seconds apart."""
+
+    def __init__(self, rps: float):
+        self.min_interval = 1.0 / rps
+        self.next_allowed = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self.next_allowed - now
+        # 先占位再等待，并发调用方会依次排到后面的时间片
+        self.next_allowed = max(now, self.next_allowed) + self.min_interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+async def call_with_backoff(limiter: RateLimiter, func, *args, attempts: int = 3, base_delay: float = 0.5, **kwargs):
+    """
+    在线程池中执行同步请求，被限频时按指数退避加随机抖动重试
+
+    Args:
+        limiter: 每个交易所实例共用的限频器
+        func: 同步请求函数
+        attempts: 最多尝试次数
+        base_delay: 首次退避时间(秒)，之后每次翻倍
+
+    Returns:
+        func的返回值
+    """
+    for attempt in range(attempts):
+        await limiter.acquire()
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except RateLimitError:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(base_delay * 2 ** attempt + random.uniform(0, base_delay))
@@ -1,19 +1,68 @@
 #!/usr/bin/env python
 
 import asyncio
+import functools
+import logging
+import time
 from decimal import Decimal
 
 from exchanges.backpack_client import BackpackClient
 from exchanges.lighter_client import LighterClient
 from helpers.logger import setup_logger
+from manager.bp_ws_manager import BackpackWebSocketManager
 from model.trading_config import TradingConfig
 from config.config import backpack_public_key, backpack_secret_key
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logger = setup_logger('king_of_hedge')
 logger.info(f'init king of hedge.')
 
+_INFO = logging.INFO
+
+# 持仓数量统一放大成定点整数处理，1个单位对应1e-6
+_QTY_SCALE = 1_000_000
+# 小于0.001的差额不对冲
+_MIN_HEDGE_Q_INT = 1000
+
+
+def _to_q_int(quantity) -> int:
+    # float先转成字符串，避免把二进制误差带进Decimal
+    if not isinstance(quantity, Decimal):
+        quantity = Decimal(str(quantity))
+    return int(quantity * _QTY_SCALE)
+
+
+def _from_q_int(q_int: int) -> Decimal:
+    return Decimal(q_int).scaleb(-6)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_unified_symbol(symbol: str, platform: str) -> str:
+    if platform != 'backpack' and platform != 'edgex':
+        return symbol
+
+    res = symbol.split('_')[0].upper()
+    stripped = res.removesuffix('USDT')
+    if stripped == res:
+        stripped = res.removesuffix('USD')
+
+    return stripped
+
 
 class KingOfHedge(object):
+    # 两轮对账之间至少间隔的秒数，避免成交推送密集时频繁请求持仓接口
+    MIN_HEDGE_INTERVAL = 1.0
+    # 提交过对冲单后等待的秒数，给lighter持仓留出更新时间，避免读到旧持仓重复对冲
+    HEDGE_SETTLE_INTERVAL = 5.0
+    # 没有成交推送时，兜底用REST对账的间隔秒数
+    RECONCILE_INTERVAL = 60
+    # websocket未连接或订阅失败时，退回按固定间隔轮询持仓
+    POLL_INTERVAL = 5.0
+
     def __init__(self):
         self.logger = logger
 
@@ -37,6 +86,16 @@ class KingOfHedge(object):
         self.backpack_client = BackpackClient(config)
         self.lighter_client = LighterClient()
 
+        # backpack有成交时由websocket回调唤醒对冲循环
+        self.hedge_event = asyncio.Event()
+        self.ws_manager = BackpackWebSocketManager(
+            public_key=backpack_public_key,
+            secret_key=backpack_secret_key,
+            symbol=None,
+            order_update_callback=self.on_order_update,
+            connection_callback=self.on_connection_change
+        )
+
     async def hedge_with_lighter(self, symbol, quantity):
         lighter_symbol = symbol
         if symbol.find('_') >= 0:
@@ -45,108 +104,132 @@ class KingOfHedge(object):
         if quantity < 0:
             await self.lighter_client.place_buy_market_order(lighter_symbol, quantity)
 
-    @staticmethod
-    def get_unified_symbol(symbol, platform):
-        if platform == 'backpack' or platform == 'edgex':
-            res = symbol.split('_')[0].upper()
-            if res.find('USDT') >= 0:
-                res = res.replace('USDT', '')
-            elif res.find('USD') >= 0:
-                res = res.replace('USD', '')
-
-            return res
-
-        return symbol
+    get_unified_symbol = staticmethod(_get_unified_symbol)
 
     async def get_need_hedge_positions(self):
-        backpack_positions = await self.backpack_client.get_account_all_positions()
-        lighter_positions = await self.lighter_client.get_positions()
-
-        self.logger.info(
-            f'backpack positions: {backpack_positions}, '
-            f'lighter positions: {lighter_positions}')
+        # 两个交易所的持仓并发获取，超时则抛出异常由run安排重试，避免拖过轮询周期
+        try:
+            backpack_positions, lighter_positions = await asyncio.wait_for(
+                asyncio.gather(
+                    self.backpack_client.get_account_all_positions(),
+                    self.lighter_client.get_positions()
+                ),
+                timeout=4.0
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning('timeout in get positions, retry hedges in next round.')
+            raise
+
+        # 持仓列表较长，INFO关闭时跳过格式化
+        if self.logger.isEnabledFor(_INFO):
+            self.logger.info('backpack positions: %s, lighter positions: %s', backpack_positions, lighter_positions)
+
+        # 先把两边持仓统一规整成(统一symbol, 定点整数数量, 原始symbol)元组，
+        # 之后的匹配和阈值比较都只做整数运算
+        lighter_norm = [
+            (_get_unified_symbol(p['symbol'], 'lighter'), _to_q_int(p['position']) * p['sign'], p['symbol'])
+            for p in lighter_positions
+        ]
+        backpack_norm = [
+            (_get_unified_symbol(p['symbol'], 'backpack'), _to_q_int(p['netQuantity']), p['symbol'])
+            for p in backpack_positions
+        ]
+
+        # 按统一后的symbol建立lighter持仓索引，只保留非零仓位
+        lighter_map = {}
+        for unified, lighter_q_int, raw in lighter_norm:
+            if lighter_q_int != 0:
+                lighter_map.setdefault(unified, (lighter_q_int, raw))
 
         need_hedge_positions = []
-        for i in range(len(backpack_positions)):
-            position = backpack_positions[i]
-            symbol = position.get('symbol')
-            bp_unified_symbol = KingOfHedge.get_unified_symbol(symbol, 'backpack')
-            quantity = position.get('netQuantity')
-            self.logger.info(f'symbol: {symbol}, quantity: {quantity}')
-
-            lighter_quantity = 0
-            is_found = False
-            for j in range(len(lighter_positions)):
-                lg_symbol = lighter_positions[j].get('symbol')
-                position = float(lighter_positions[j].get('position'))
-                sign = lighter_positions[j].get('sign')
-                lighter_unified_symbol = KingOfHedge.get_unified_symbol(lg_symbol, 'lighter')
-
-                if abs(position) == 0:
-                    continue
-
-                if lighter_unified_symbol == bp_unified_symbol:
-                    is_found = True
-                    lighter_quantity = position * sign
-                    break
-
-            need_hedge_quantity = -float(quantity) - float(lighter_quantity)
+        matched_symbols = set()
+        for unified, q_int, raw in backpack_norm:
+            matched_symbols.add(unified)
+            lighter_q_int, _ = lighter_map.get(unified, (0, None))
+            need_q_int = -q_int - lighter_q_int
             need_hedge_positions.append({
-                'symbol': bp_unified_symbol,
-                'quantity': need_hedge_quantity
+                'symbol': unified,
+                'quantity': _from_q_int(need_q_int),
+                'q_int': need_q_int
             })
 
-        for j in range(len(lighter_positions)):
-            lg_symbol = lighter_positions[j].get('symbol')
-            position = float(lighter_positions[j].get('position'))
-            sign = lighter_positions[j].get('sign')
-            lighter_unified_symbol = KingOfHedge.get_unified_symbol(lg_symbol, 'lighter')
-            lighter_quantity = float(position * sign)
-
-            if abs(lighter_quantity) == 0:
-                continue
-
-            is_found = False
-            for i in range(len(backpack_positions)):
-                position = backpack_positions[i]
-                symbol = position.get('symbol')
-                bp_unified_symbol = KingOfHedge.get_unified_symbol(symbol, 'backpack')
-                quantity = position.get('netQuantity')
-                self.logger.info(f'symbol: {symbol}, quantity: {quantity}')
-
-                if lighter_unified_symbol == bp_unified_symbol:
-                    is_found = True
-                    break
-
-            if not is_found:
+        # backpack没有对应持仓的lighter仓位需要全部平掉
+        for unified, (lighter_q_int, raw) in lighter_map.items():
+            if unified not in matched_symbols:
                 need_hedge_positions.append({
-                    'symbol': lg_symbol,
-                    'quantity': -float(lighter_quantity)
+                    'symbol': raw,
+                    'quantity': _from_q_int(-lighter_q_int),
+                    'q_int': -lighter_q_int
                 })
 
         return need_hedge_positions
 
+    async def _safe(self, coro):
+        try:
+            return await coro
+        except Exception as e:
+            self.logger.info(f'exception in do hedges: {e}')
+            return e
+
     async def do_hedges(self, need_hedge_positions):
-        for i in range(len(need_hedge_positions)):
-            try:
-                symbol = need_hedge_positions[i]['symbol']
-                quantity = need_hedge_positions[i]['quantity']
-                if quantity >= 0.001:
-                    await self.lighter_client.place_buy_market_order(symbol, abs(quantity))
-                elif quantity <= -0.001:
-                    await self.lighter_client.place_sell_market_order(symbol, abs(quantity))
-            except Exception as e:
-                self.logger.info(f'exception in do hedges: {e}')
+        # 不同币种的对冲单相互独立，并发下单以缩短两边敞口不一致的时间
+        tasks = []
+        for position in need_hedge_positions:
+            symbol = position['symbol']
+            q_int = position['q_int']
+            if q_int >= _MIN_HEDGE_Q_INT:
+                tasks.append(self._safe(self.lighter_client.place_buy_market_order(symbol, _from_q_int(q_int))))
+            elif q_int <= -_MIN_HEDGE_Q_INT:
+                tasks.append(self._safe(self.lighter_client.place_sell_market_order(symbol, _from_q_int(-q_int))))
+
+        return await asyncio.gather(*tasks)
+
+    async def on_order_update(self, order_data):
+        # 只有成交会改变持仓
+        if order_data.get('e') == 'orderFill':
+            self.hedge_event.set()
+
+    async def on_connection_change(self, subscribed):
+        # 重新订阅后补做一次对账，覆盖断线期间丢失的成交推送；
+        # 断线时也唤醒等待中的循环，让它改为按POLL_INTERVAL轮询
+        self.hedge_event.set()
+
+    async def wait_for_fills(self, tick_start, wait_until):
+        # 先等到本轮允许的最早时间，再等待新的成交推送
+        await asyncio.sleep(max(0.0, wait_until - time.monotonic()))
+        interval = self.RECONCILE_INTERVAL if self.ws_manager.subscribed else self.POLL_INTERVAL
+        try:
+            await asyncio.wait_for(
+                self.hedge_event.wait(),
+                timeout=max(0.0, tick_start + interval - time.monotonic()))
+        except asyncio.TimeoutError:
+            self.logger.info('no fills received, reconcile positions.')
 
     async def run(self):
-        while True:
-            try:
-                need_hedge_positions = await self.get_need_hedge_positions()
-                self.logger.info(f'need hedge positions: {need_hedge_positions}')
-                await self.do_hedges(need_hedge_positions)
-                await asyncio.sleep(5)
-            except Exception as e:
-                self.logger.info(f'exception in run: {e}')
+        ws_task = asyncio.create_task(self.ws_manager.connect())
+        try:
+            while True:
+                # 对账间隔从本轮开始计时，对账耗时不再叠加到间隔上
+                tick_start = time.monotonic()
+                wait_until = tick_start + self.MIN_HEDGE_INTERVAL
+                # 先清除事件再拉持仓，对账过程中到达的成交会触发下一轮
+                self.hedge_event.clear()
+                try:
+                    need_hedge_positions = await self.get_need_hedge_positions()
+                    if self.logger.isEnabledFor(_INFO):
+                        self.logger.info('need hedge positions: %s', need_hedge_positions)
+                    if await self.do_hedges(need_hedge_positions):
+                        # 本轮发出了对冲单，从下单结束起等待lighter持仓更新后再对账
+                        wait_until = time.monotonic() + self.HEDGE_SETTLE_INTERVAL
+                except Exception as e:
+                    self.logger.info(f'exception in run: {e}')
+                    # 本轮没有完成对账，触发过本轮的成交还没对冲，间隔MIN_HEDGE_INTERVAL后立即重试
+                    self.hedge_event.set()
+
+                await self.wait_for_fills(tick_start, wait_until)
+        finally:
+            await self.ws_manager.disconnect()
+            ws_task.cancel()
 
 
 async def main():
@@ -161,4 +244,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -14,51 +14,117 @@ from cryptography.hazmat.primitives.asymmetric import ed25519
 
 from helpers.logger import setup_logger
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# 安装了PyNaCl时用libsodium签名，比cryptography的Ed25519更快
+try:
+    from nacl.signing import SigningKey
+except ImportError:
+    SigningKey = None
+
+# 签名消息的固定前缀，预先编码好，签名时只拼接时间戳部分
+_SUBSCRIBE_PREFIX = b"instruction=subscribe&timestamp="
+
 logger = setup_logger('bp_ws_manager')
 
 
 class BackpackWebSocketManager:
     """WebSocket manager for Backpack order updates."""
 
-    def __init__(self, public_key: str, secret_key: str, symbol: str, order_update_callback):
+    # 连接保持超过该秒数才视为健康连接，断开后重连退避从头开始
+    STABLE_CONNECTION_SECONDS = 30
+
+    def __init__(self, public_key: str, secret_key: str, symbol: Optional[str], order_update_callback,
+                 connection_callback=None):
         self.public_key = public_key
         self.secret_key = secret_key
         self.symbol = symbol
         self.order_update_callback = order_update_callback
+        # 订阅成功/连接断开时以True/False回调，调用方据此补做对账或切换到轮询
+        self.connection_callback = connection_callback
+        self.subscribed = False
         self.websocket = None
         self.running = False
         self.ws_url = "wss://ws.backpack.exchange"
         self.logger = logger
+        # 当前连接是否收到过订阅流的推送
+        self._stream_received = False
 
         # Initialize ED25519 private key from base64 decoded secret
-        self.private_key = ed25519.Ed25519PrivateKey.from_private_bytes(
-            base64.b64decode(secret_key)
-        )
+        secret_bytes = base64.b64decode(secret_key)
+        if SigningKey is not None:
+            self._signing_key = SigningKey(secret_bytes)
+            self._sign = lambda message: self._signing_key.sign(message).signature
+        else:
+            self.private_key = ed25519.Ed25519PrivateKey.from_private_bytes(secret_bytes)
+            self._sign = self.private_key.sign
 
     def _generate_signature(self, instruction: str, timestamp: int, window: int = 5000) -> str:
         """Generate ED25519 signature for WebSocket authentication."""
-        # Create the message string in the same format as BPX package
-        message = f"instruction={instruction}&timestamp={timestamp}&window={window}"
+        # Create the message in the same format as BPX package
+        if instruction == "subscribe":
+            message = _SUBSCRIBE_PREFIX + b"%d&window=%d" % (timestamp, window)
+        else:
+            message = b"instruction=%s&timestamp=%d&window=%d" % (instruction.encode(), timestamp, window)
 
         # Sign the message using ED25519 private key
-        signature_bytes = self.private_key.sign(message.encode())
+        signature_bytes = self._sign(message)
 
         # Return base64 encoded signature
         return base64.b64encode(signature_bytes).decode()
 
     async def connect(self):
-        """Connect to Backpack WebSocket."""
-        try:
-            self.websocket = await websockets.connect(self.ws_url)
-            self.running = True
+        """Connect to Backpack WebSocket and reconnect with exponential backoff until disconnected."""
+        self.running = True
+        delay = 0.5
+        while self.running:
+            self._stream_received = False
+            started = time.monotonic()
+            try:
+                await self._connect_once()
+            except Exception:
+                # 错误已在_connect_once中记录，这里只负责退避重连
+                pass
+
+            # 订阅后马上被服务端断开(如签名错误)也会正常返回，只有收到过推送
+            # 或连接保持足够久才从最短间隔开始重连，否则继续按指数退避
+            if self._stream_received or time.monotonic() - started >= self.STABLE_CONNECTION_SECONDS:
+                delay = 0.5
+
+            if not self.running:
+                break
+
+            if self.logger:
+                self.logger.warning(f"WebSocket reconnecting in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
 
-            # Subscribe to order updates for the specific symbol
+    async def _connect_once(self):
+        """Connect, subscribe and listen until the connection is closed."""
+        try:
+            # 加大消息队列应对突发的订单推送，缩短心跳间隔以便尽快发现断线
+            self.websocket = await websockets.connect(
+                self.ws_url,
+                compression='deflate',
+                ping_interval=15,
+                ping_timeout=10,
+                max_queue=1024,
+                write_limit=2 ** 20
+            )
+
+            # Subscribe to order updates for the specific symbol, signed again on every
+            # reconnect because the signature is only valid for a 5s window
             timestamp = int(time.time() * 1000)
             signature = self._generate_signature("subscribe", timestamp)
 
+            # symbol为空时订阅账户下所有市场的订单更新
+            stream = f"account.orderUpdate.{self.symbol}" if self.symbol else "account.orderUpdate"
             subscribe_message = {
                 "method": "SUBSCRIBE",
-                "params": [f"account.orderUpdate.{self.symbol}"],
+                "params": [stream],
                 "signature": [
                     self.public_key,
                     signature,
@@ -69,7 +135,8 @@ class BackpackWebSocketManager:
 
             await self.websocket.send(json.dumps(subscribe_message))
             if self.logger:
-                self.logger.info(f"Subscribed to order updates for {self.symbol}")
+                self.logger.info(f"Subscribed to order updates for {self.symbol or 'all markets'}")
+            await self._set_subscribed(True)
 
             # Start listening for messages
             await self._listen()
@@ -78,6 +145,21 @@ class BackpackWebSocketManager:
             if self.logger:
                 self.logger.error(f"WebSocket connection error: {e}")
             raise
+        finally:
+            await self._set_subscribed(False)
+
+    async def _set_subscribed(self, subscribed: bool):
+        """更新订阅状态，状态变化时通知调用方。"""
+        if self.subscribed == subscribed:
+            return
+
+        self.subscribed = subscribed
+        try:
+            if self.connection_callback:
+                await self.connection_callback(subscribed)
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"Error handling connection change: {e}")
 
     async def _listen(self):
         """Listen for WebSocket messages."""
@@ -87,7 +169,7 @@ class BackpackWebSocketManager:
                     break
 
                 try:
-                    data = json.loads(message)
+                    data = json_loads(message)
                     self.logger.info(f'listen data: {data}')
                     await self._handle_message(data)
                 except json.JSONDecodeError as e:
@@ -113,7 +195,12 @@ class BackpackWebSocketManager:
             self.logger.info(f'handle message, stream: {stream}, payload: {payload}')
 
             if 'orderUpdate' in stream:
+                self._stream_received = True
                 await self._handle_order_update(payload)
+            elif 'error' in data:
+                # 订阅被拒绝(如签名错误)时连接可能仍然保持，但不会再有推送
+                self.logger.error(f"WebSocket subscription error: {data}")
+                await self._set_subscribed(False)
             else:
                 self.logger.error(f"Unknown WebSocket message: {data}")
 
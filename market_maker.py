@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import asyncio
+import logging
 import time
 import traceback
 from decimal import Decimal
@@ -10,12 +11,22 @@ from model.trading_config import TradingConfig
 from config.config import backpack_public_key, backpack_secret_key
 from helpers.logger import setup_logger
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logger = setup_logger('market_maker')
 
+_INFO = logging.INFO
+
 
 class MarketMaker:
     """Modular Trading Bot - Main trading logic supporting multiple exchanges."""
 
+    # 未成交比例的平滑系数，避免单轮成交波动导致挂单数量来回切换
+    BACKLOG_EWMA_ALPHA = 0.3
+
     def __init__(self, config: TradingConfig):
         self.config = config
         self.logger = logger
@@ -30,19 +41,28 @@ class MarketMaker:
         self.active_close_orders = []
         self.all_limit_orders = []
         self.last_log_time = 0
+        # close_all_orders确认该合约已无挂单的时间，状态日志据此省掉一次查询
+        self._orders_cleared_at = 0
+        # 上一轮实际挂出的订单数，以及平滑后的未成交比例
+        self._last_placed_count = 0
+        self._unfilled_ratio = 0.0
 
     async def _log_status_periodically(self):
         """Log status information periodically, including positions."""
         if time.time() - self.last_log_time > 60 or self.last_log_time == 0:
             print("--------------------------------")
             try:
-                # Get active orders
-                active_orders = await self.exchange_client.get_active_orders(self.config.contract_id)
+                # Get active orders, skip the request if close_all_orders has just cleared them
+                if time.time() - self._orders_cleared_at < 1.0:
+                    active_orders = []
+                else:
+                    active_orders = await self.exchange_client.get_active_orders(self.config.contract_id)
 
                 # Filter close orders
                 self.active_close_orders = []
+                close_order_side = self.config.close_order_side
                 for order in active_orders:
-                    if order.side == self.config.close_order_side:
+                    if order.side == close_order_side:
                         self.active_close_orders.append({
                             'id': order.order_id,
                             'price': order.price,
@@ -59,15 +79,56 @@ class MarketMaker:
                     if isinstance(order, dict)
                 )
 
-                self.logger.info(f"Current Position: {position_amt} | Active closing amount: {active_close_amount}")
+                self.logger.info('Current Position: %s | Active closing amount: %s', position_amt, active_close_amount)
             except Exception as e:
                 self.logger.error(
                     f"Error in periodic status check: {e}, "
                     f"Traceback: {traceback.format_exc()}")
 
+    def _backlog_order_num(self, pending: int) -> int:
+        """根据上一轮挂单的未成交比例决定本轮每侧挂单数量。"""
+        order_num = self.config.max_orders
+        if self.config.backlog_unfilled_ratio <= 0:
+            return order_num
+
+        # 上一轮没有挂出订单时没有成交信号，保持原来的比例
+        if self._last_placed_count > 0:
+            ratio = min(pending / self._last_placed_count, 1.0)
+            alpha = self.BACKLOG_EWMA_ALPHA
+            self._unfilled_ratio = alpha * ratio + (1 - alpha) * self._unfilled_ratio
+
+        if self._unfilled_ratio >= self.config.backlog_unfilled_ratio:
+            self.logger.info(
+                'unfilled ratio %.2f reach %s, place %s orders only',
+                self._unfilled_ratio, self.config.backlog_unfilled_ratio, self.config.order_num_min)
+            return self.config.order_num_min
+
+        return self.config.order_num_max or order_num
+
+    def _count_placed(self, result):
+        # 下单成功时返回订单ID列表，失败时返回OrderResult
+        if isinstance(result, list):
+            self._last_placed_count += len(result)
+
+    async def _cancel_orders(self, orders):
+        """并发撤销一组订单"""
+        order_ids = [order.get('id') for order in orders]
+        results = await asyncio.gather(
+            *(self.exchange_client.cancel_order(order_id) for order_id in order_ids),
+            return_exceptions=True
+        )
+
+        for order_id, cancel_order_result in zip(order_ids, results):
+            if isinstance(cancel_order_result, Exception):
+                self.logger.warning(f'exception in cancel order: {order_id}, {cancel_order_result}')
+            elif self.logger.isEnabledFor(_INFO):
+                self.logger.info('cancel order: %s, cancel order result: %s', order_id, cancel_order_result)
+
     async def close_all_orders(self):
         # Get active orders
         active_orders = await self.exchange_client.get_active_orders(self.config.contract_id)
+        # 撤单前拉到的列表马上就会过期，不能留给状态日志复用
+        self._orders_cleared_at = 0
 
         # Filter close orders
         self.active_close_orders = []
@@ -78,32 +139,32 @@ class MarketMaker:
                 'size': order.size
             })
 
-        self.logger.info(
-            f'start to close all active orders, active orders count: {len(self.active_close_orders)}, '
-            f'active orders: {self.active_close_orders}')
+        if self.logger.isEnabledFor(_INFO):
+            self.logger.info(
+                'start to close all active orders, active orders count: %d, active orders: %s',
+                len(self.active_close_orders), self.active_close_orders)
 
-        for i in range(len(self.active_close_orders)):
-            try:
-                order_id = self.active_close_orders[i].get('id')
-                cancel_order_result = await self.exchange_client.cancel_order(order_id)
-                self.logger.info(f'cancel order: {order_id}, cancel order result: {cancel_order_result}')
-            except Exception as e:
-                self.logger.warning(f'exception in cancel order: {e}')
+        if not self.active_close_orders:
+            self._orders_cleared_at = time.time()
+            return
+
+        # 优先一次请求撤掉该合约的全部挂单，失败时再逐单并发撤单
+        cancel_all_result = await self.exchange_client.cancel_all_orders(self.config.contract_id)
+        if self.logger.isEnabledFor(_INFO):
+            self.logger.info('cancel all orders result: %s', cancel_all_result)
+        if cancel_all_result.success:
+            self._orders_cleared_at = time.time()
+        else:
+            await self._cancel_orders(self.active_close_orders)
 
     async def close_all_limit_orders(self):
         # Get active orders
-        self.logger.info(
-            f'start to close all active orders, active orders count: {len(self.all_limit_orders)}, '
-            f'active orders: {self.all_limit_orders}')
-
-        for i in range(len(self.all_limit_orders)):
-            try:
-                order_id = self.all_limit_orders[i].get('id')
-                cancel_order_result = await self.exchange_client.cancel_order(order_id)
-                self.logger.info(f'cancel order: {order_id}, cancel order result: {cancel_order_result}')
-            except Exception as e:
-                self.logger.warning(f'exception in cancel order: {e}')
+        if self.logger.isEnabledFor(_INFO):
+            self.logger.info(
+                'start to close all active orders, active orders count: %d, active orders: %s',
+                len(self.all_limit_orders), self.all_limit_orders)
 
+        await self._cancel_orders(self.all_limit_orders)
         self.all_limit_orders = []
 
     async def run(self):
@@ -115,64 +176,70 @@ class MarketMaker:
             max_position_count = self.config.max_position_count
 
             while True:
+                tick_start = time.monotonic()
                 try:
+                    # 撤单完成后再读持仓，撤单期间成交的数量才会计入仓位风控
                     await self.close_all_orders()
-
-                    curr_contract_amount = 0
+                    # close_all_orders在撤单前拉取的挂单就是上一轮挂出后没有成交的部分，每轮只统计一次
+                    order_num = self._backlog_order_num(len(self.active_close_orders))
+                    self._last_placed_count = 0
                     all_positions = await self.exchange_client.get_account_all_positions()
-                    for i in range(len(all_positions)):
-                        if all_positions[i]['symbol'] == self.config.contract_id:
-                            curr_contract_amount = all_positions[i]['netQuantity']
-                            break
+
+                    positions_by_symbol = {p['symbol']: p for p in all_positions}
+                    curr_contract_amount = positions_by_symbol.get(self.config.contract_id, {}).get('netQuantity', 0)
 
                     position_rate = round(curr_contract_amount / max_position_count, 2)
 
                     await self._log_status_periodically()
 
                     if abs(curr_contract_amount) < max_position_count:
-                        await self.exchange_client.batch_place_buy_limit_orders(
-                            contract_id=self.config.contract_id,
-                            quantity=self.config.quantity,
-                            order_num=self.config.max_orders,
-                            position_rate=position_rate
-                        )
-
-                        await self.exchange_client.batch_place_sell_limit_orders(
-                            contract_id=self.config.contract_id,
-                            quantity=self.config.quantity,
-                            order_num=self.config.max_orders,
-                            position_rate=position_rate
-
+                        # 买卖两侧互不依赖，并发下单；等两侧都结束再进入下一轮撤单，避免留下孤儿挂单
+                        results = await asyncio.gather(
+                            self.exchange_client.batch_place_buy_limit_orders(
+                                contract_id=self.config.contract_id,
+                                quantity=self.config.quantity,
+                                order_num=order_num,
+                                position_rate=position_rate
+                            ),
+                            self.exchange_client.batch_place_sell_limit_orders(
+                                contract_id=self.config.contract_id,
+                                quantity=self.config.quantity,
+                                order_num=order_num,
+                                position_rate=position_rate
+                            ),
+                            return_exceptions=True
                         )
+                        for side_name, result in zip(('buy', 'sell'), results):
+                            if isinstance(result, Exception):
+                                self.logger.warning(f'exception in batch place {side_name} limit orders: {result}')
+                            else:
+                                self._count_placed(result)
                     elif curr_contract_amount >= max_position_count:
-                        self.logger.info(
-                            f'curr contract amount: {curr_contract_amount}, '
-                            f'only sell it.')
-                        await self.exchange_client.batch_place_sell_limit_orders(
+                        self.logger.info('curr contract amount: %s, only sell it.', curr_contract_amount)
+                        self._count_placed(await self.exchange_client.batch_place_sell_limit_orders(
                             contract_id=self.config.contract_id,
                             quantity=self.config.quantity,
-                            order_num=self.config.max_orders,
+                            order_num=order_num,
                             position_rate=position_rate
-                        )
+                        ))
                     else:
-                        self.logger.info(
-                            f'curr contract amount: {curr_contract_amount}, '
-                            f'only buy it.')
-                        await self.exchange_client.batch_place_buy_limit_orders(
+                        self.logger.info('curr contract amount: %s, only buy it.', curr_contract_amount)
+                        self._count_placed(await self.exchange_client.batch_place_buy_limit_orders(
                             contract_id=self.config.contract_id,
                             quantity=self.config.quantity,
-                            order_num=self.config.max_orders,
+                            order_num=order_num,
                             position_rate=position_rate
-                        )
+                        ))
 
-                    await asyncio.sleep(self.config.wait_time)
+                    # 按本轮开始时间计算剩余等待，保证挂单周期稳定为wait_time
+                    await asyncio.sleep(max(0.0, self.config.wait_time - (time.monotonic() - tick_start)))
                 except Exception as e:
                     self.logger.warning(f"exception in process: {e}")
         except Exception as e:
             traceback.print_exc()
             self.logger.error(f"Critical error: {e}")
-            await self.close_all_orders()
         finally:
+            # 无论正常退出还是异常退出，都只在这里撤一次单
             try:
                 await self.close_all_orders()
             except Exception as e:
@@ -208,4 +275,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
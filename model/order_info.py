@@ -4,7 +4,7 @@ from dataclasses import dataclass
 from decimal import Decimal
 
 
-@dataclass
+@dataclass(slots=True)
 class OrderInfo:
     """Standardized order information structure."""
     order_id: str
@@ -5,7 +5,7 @@ from decimal import Decimal
 from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class OrderResult:
     """Standardized order result structure."""
     success: bool
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from decimal import Decimal
 
 
-@dataclass
+@dataclass(slots=True)
 class TradingConfig:
     """Configuration class for trading parameters."""
     ticker: str
@@ -21,9 +21,13 @@ class TradingConfig:
     exchange: str
     public_key: str
     secret_key: str
+    # 挂单积压控制：上一轮挂出的订单到本轮仍未成交的比例(按轮平滑) >= backlog_unfilled_ratio 时
+    # 每侧只挂 order_num_min 单，否则挂 order_num_max 单（为0时沿用 max_orders），backlog_unfilled_ratio 为0时关闭
+    backlog_unfilled_ratio: float = 0.0
+    order_num_min: int = 1
+    order_num_max: int = 0
+    close_order_side: str = field(init=False, repr=False)
 
-
-    @property
-    def close_order_side(self) -> str:
-        """Get the close order side based on bot direction."""
-        return 'buy' if self.direction == "sell" else 'sell'
+    def __post_init__(self):
+        """Compute the close order side based on bot direction once."""
+        self.close_order_side = 'buy' if self.direction == "sell" else 'sell'